@@ -9,13 +9,14 @@
 # in cron.
 #
 import pickle
+import marshal
 import apt
 import getopt
 import apt_pkg
 import sys
 import os
-import email
-import tempfile
+import email.utils
+import shutil
 import datetime
 import time
 
@@ -52,27 +53,47 @@ class AlertRegistry():
     Tracks for which UNTs alerts have already been printed.
     The state can easily be reset by removing the 'alerts.pickle' file.
 
-    The registry file is just a pickled Python list object containing
-    UNT identifiers as strings.
+    The registry file is just a marshalled Python list object containing
+    UNT identifiers as strings. Older, pickled registry files are still
+    read and are converted on the next save.
     """
     def __init__(self, storage_file='alerts.pickle'):
         self.storage_file = storage_file
+        self._dirty = False
         try:
             with open(storage_file, 'rb+') as f:
-                self.registry = pickle.load(f)
+                try:
+                    self.registry = set(marshal.load(f))
+                except (EOFError, ValueError, TypeError):
+                    f.seek(0, 0)
+                    self.registry = set(pickle.load(f))
+                    # Rewrite it in the current format.
+                    self._dirty = True
         except FileNotFoundError:
-            self.registry = []
+            self.registry = set()
+            self._dirty = True
             self.save()
 
     def register(self, unt):
-        self.registry.append(unt)
+        self.registry.add(unt)
+        self._dirty = True
 
     def is_registered(self, unt):
         return (unt in self.registry)
 
     def save(self):
-        with open(self.storage_file, 'wb') as f:
-            pickle.dump(self.registry, f)
+        if not self._dirty:
+            return
+
+        # Write to a temporary file first so a crash halfway through can't
+        # leave a truncated registry behind. os.rename() replaces the
+        # target atomically on POSIX, and unlike os.replace() it exists on
+        # Python 3.2.
+        tmp_file = self.storage_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            marshal.dump(list(self.registry), f)
+        os.rename(tmp_file, self.storage_file)
+        self._dirty = False
 
 
 def database_file():
@@ -94,116 +115,153 @@ def database_file():
     if not CONFIG['PERSISTENT_STORAGE']:
         connection = HTTPConnection(host, timeout=10)
         connection.request('GET', url)
-        response = connection.getresponse()
-        t = tempfile.TemporaryFile()
-        t.write(response.read())
-        t.seek(0, 0)
-        return t
-
-    # HEAD request; the ETag value is the primary source for caching,
-    # falling back on Last-Modified.  That is probably not HTTP-compliant
-    # but, like, whatevs.
-    connection = HTTPConnection(host, timeout=10)
-    response = connection.request('HEAD', url,
-                                  headers={'User-Agent': 'unt-scan.py {}'.format(__version__)})
-    response = connection.getresponse()
-    connection.close()
+        # The response is file-like, so it can go straight to pickle.load().
+        return connection.getresponse()
 
-    if response.status != 200:
-        raise Exception('Unexpected response while doing HEAD request on {}'.format(url))
+    db_path = os.path.join(CONFIG['DIRECTORY'], 'db.pickle')
+    metadata_path = os.path.join(CONFIG['DIRECTORY'], 'db.metadata.pickle')
 
-    # Tuples are annoying. Restructure to dict.
-    headers_tuples = response.getheaders()
-    headers = {}
-    for item in headers_tuples:
-        headers[item[0]] = item[1]
-
-    # Just save the HTTP headers so we can check the previous run's ETag etc.
+    # Headers saved from the previous run, so we can send its ETag etc.
     try:
-        f = open(os.path.join(CONFIG['DIRECTORY'], 'db.metadata.pickle'), 'rb+')
-        old_headers = pickle.load(f)
-        f.seek(0, 0)
+        with open(metadata_path, 'rb') as f:
+            old_headers = pickle.load(f)
     except FileNotFoundError:
-        f = open(os.path.join(CONFIG['DIRECTORY'], 'db.metadata.pickle'), 'wb+')
         old_headers = {}
 
-    pickle.dump(headers, f)
-    f.close()
+    # If the cached file is gone for whatever reason, do an unconditional
+    # GET so we don't end up with a 304 and nothing to read.
+    try:
+        cached = open(db_path, 'rb')
+    except Exception:
+        cached = None
+        old_headers = {}
 
-    update = True
-    if 'ETag' in headers and 'ETag' in old_headers:
-        if headers['ETag'] == old_headers['ETag']:
-            update = False
-    elif 'Last-Modified' in headers and 'Last-Modified' in old_headers:
-        if old_headers['Last-Modified'] < headers['Last-Modified']:
-            update = False
+    # Conditional GET; the server answers 304 if our copy is still current,
+    # which saves doing a separate HEAD request first.
+    request_headers = {'User-Agent': 'unt-scan.py {}'.format(__version__)}
+    if old_headers.get('ETag'):
+        request_headers['If-None-Match'] = old_headers['ETag']
+    if old_headers.get('Last-Modified'):
+        request_headers['If-Modified-Since'] = old_headers['Last-Modified']
 
-    # If we don't need to update, return the file-handle to the cached file.
-    # If that fails for whatever reason, try to update anyway.
-    if not update:
-        try:
-            response = open(os.path.join(CONFIG['DIRECTORY'], 'db.pickle'), 'rb')
-        except Exception:
-            update = True
+    connection = HTTPConnection(host, timeout=10)
+    connection.request('GET', url, headers=request_headers)
+    response = connection.getresponse()
 
-    if update:
-        connection = HTTPConnection(host, timeout=10)
-        response = connection.request('GET', url,
-                                      headers={'User-Agent': 'unt-scan.py {}'.format(__version__)})
-        response = connection.getresponse()
+    if response.status == 304 and cached is not None:
+        connection.close()
+        return cached
 
-        # This is more likely to raise one of the http.client exceptions, but just check
-        # to be sure.
-        if (not response) or (response.status != 200):
-            raise Exception('Error retrieving pickle database: Got code {}'.
-                            format(response.status))
+    if cached is not None:
+        cached.close()
 
-        f = open(os.path.join(CONFIG['DIRECTORY'], 'db.pickle'), 'wb+')
-        f.write(response.read())
-        f.seek(0, 0)
-        response = f
+    # This is more likely to raise one of the http.client exceptions, but just check
+    # to be sure.
+    if (not response) or (response.status != 200):
+        raise Exception('Error retrieving pickle database: Got code {}'.
+                        format(response.status))
 
-        connection.close()
+    # Tuples are annoying. Restructure to dict.
+    headers = dict(response.getheaders())
 
-    return response
+    f = open(db_path, 'wb+')
+    shutil.copyfileobj(response, f, 1 << 20)
+    f.seek(0, 0)
+    connection.close()
 
+    # Only store the headers once the new database is actually on disk.
+    with open(metadata_path, 'wb') as m:
+        pickle.dump(headers, m, protocol=pickle.HIGHEST_PROTOCOL)
 
-def filter_db(db, release_codename):
+    return f
+
+
+def filter_db(db, release_codename, installed_names=None):
     """
     This generator filters the provided pickle database by releasename and restructures"
     the input a little bit, to make it easier to parse.
+
+    If installed_names is given, only packages whose name is in it are yielded.
     """
     now = time.time()
     for unt, content in db.items():
-        if release_codename not in list(content['releases'].keys()):
+        if release_codename not in content['releases']:
             continue
         elif content['timestamp'] > (now - CONFIG['MINIMUM_AGE']):
             continue
         else:
-            for package, contents in content['releases'][release_codename]['binaries'].items():
-                # I don't even know what these are, but this seems to work.
-                if 'isummary' in content:
-                    summary = content['isummary']
-                elif 'summary' in content:
-                    summary = content['summary']
-                else:
-                    summary = 'No summary'
+            release = content['releases'][release_codename]
+
+            # These are the same for every binary package in the UNT.
+            # I don't even know what these are, but this seems to work.
+            if 'isummary' in content:
+                summary = content['isummary']
+            elif 'summary' in content:
+                summary = content['summary']
+            else:
+                summary = 'No summary'
+            cves = content['cves']
+            timestamp = content['timestamp']
+
+            for package, contents in release['binaries'].items():
+                # Most packages in the database aren't installed here, so
+                # don't bother building a dict for them.
+                if installed_names is not None and package not in installed_names:
+                    continue
 
                 yield {
                     'unt': unt,
                     'name': package,
                     'version': contents['version'],
                     'summary': summary,
-                    'cves': content['cves'],
-                    'timestamp': content['timestamp'],
+                    'cves': cves,
+                    'timestamp': timestamp,
                 }
 
 
+def scan_is_current(codename):
+    """
+    Returns True if a previous run already scanned the current database for
+    this codename, and neither the installed packages nor the alert registry
+    changed since then. In that case the scan can't produce any new alerts
+    and can be skipped.
+    """
+    marker = os.path.join(CONFIG['DIRECTORY'], 'last-scan')
+    try:
+        with open(marker, 'r') as f:
+            last_codename, registry_mtime = f.read().split()
+        last_scan = os.path.getmtime(marker)
+        db_mtime = os.path.getmtime(os.path.join(CONFIG['DIRECTORY'], 'db.pickle'))
+        dpkg_mtime = os.path.getmtime('/var/lib/dpkg/status')
+        # Removing or emptying the registry resets the alerts, so that has to
+        # force a new scan too.
+        current_registry_mtime = os.path.getmtime(os.path.join(CONFIG['DIRECTORY'], 'alerts.pickle'))
+    except (IOError, OSError, ValueError):
+        return False
+
+    return last_codename == codename and db_mtime <= last_scan and dpkg_mtime < last_scan and \
+        repr(current_registry_mtime) == registry_mtime
+
+
+def record_scan(codename, started):
+    """
+    Marks the database as scanned for codename, along with the mtime of the
+    alert registry as it was left by the scan. The marker's mtime is set to
+    when the scan started, so packages installed during the scan still
+    trigger a new one next time.
+    """
+    marker = os.path.join(CONFIG['DIRECTORY'], 'last-scan')
+    registry_mtime = os.path.getmtime(os.path.join(CONFIG['DIRECTORY'], 'alerts.pickle'))
+    with open(marker, 'w') as f:
+        f.write('{}\n{!r}\n'.format(codename, registry_mtime))
+    os.utime(marker, (started, started))
+
+
 def get_codename():
     with open('/etc/lsb-release', 'r') as f:
-        for line in f.readlines():
+        for line in f:
             if line.startswith('DISTRIB_CODENAME='):
-                return line.split('=')[1].rstrip()
+                return line[len('DISTRIB_CODENAME='):].rstrip()
 
 
 def show_age():
@@ -275,6 +333,15 @@ if __name__ == '__main__':
             raise Exception('{} exists, but is not a directory.'.format(CONFIG['DIRECTORY']))
 
     db_file = database_file()
+
+    # Building the apt cache is by far the slowest part of a run. If nothing
+    # changed since the last scan, it would only find alerts that were
+    # already printed. That doesn't hold with --all, or with a minimum age,
+    # as older UNTs become eligible over time.
+    if CONFIG['ALERT_ONCE'] and CONFIG['MINIMUM_AGE'] == 0 and scan_is_current(codename):
+        sys.exit(0)
+
+    scan_started = time.time()
     db = pickle.load(db_file, encoding='iso-8859-1')
 
     apt_pkg.init_system()
@@ -282,26 +349,34 @@ if __name__ == '__main__':
 
     registry = AlertRegistry(os.path.join(CONFIG['DIRECTORY'], 'alerts.pickle'))
 
-    for package in filter_db(db, codename):
-        if package['name'] in cache and cache[package['name']].is_installed:
-            cached_package = cache[package['name']]
-            if apt_pkg.version_compare(cached_package.installed.version, package['version']) < 0:
-                if CONFIG['ALERT_ONCE']:
-                    alert = not registry.is_registered(package['unt'])
-                else:
-                    alert = True
-
-                if alert:
-                    registry.register(package['unt'])
-                    issues_found = True
-
-                    print('UNT: {}\n   CVEs: {}'.format(package['unt'], ', '.join(package['cves'])))
-                    print('   Published: {}'.format(datetime.datetime.fromtimestamp(int(package['timestamp'])).strftime('%Y-%m-%d %H:%M:%S')))
-                    print('   Package: {}\n   Installed version: {}\n   Fix Version: {}'.
-                          format(package['name'], cached_package.installed.version, package['version']))
-                    print('   Short Summary: {}'.format(package['summary']))
+    # Looking packages up in the apt cache is relatively expensive, and the
+    # same package shows up in many UNTs. Collect installed versions once.
+    installed = {p.name: p.installed.version for p in cache if p.is_installed}
+
+    for package in filter_db(db, codename, installed):
+        installed_version = installed[package['name']]
+        if apt_pkg.version_compare(installed_version, package['version']) < 0:
+            if CONFIG['ALERT_ONCE']:
+                alert = not registry.is_registered(package['unt'])
+            else:
+                alert = True
+
+            if alert:
+                registry.register(package['unt'])
+                issues_found = True
+
+                print('UNT: {}\n   CVEs: {}'.format(package['unt'], ', '.join(package['cves'])))
+                print('   Published: {}'.format(datetime.datetime.fromtimestamp(int(package['timestamp'])).strftime('%Y-%m-%d %H:%M:%S')))
+                print('   Package: {}\n   Installed version: {}\n   Fix Version: {}'.
+                      format(package['name'], installed_version, package['version']))
+                print('   Short Summary: {}'.format(package['summary']))
 
     registry.save()
 
+    # Only a full scan in --once mode is what scan_is_current() assumes has
+    # happened. A scan with a minimum age leaves newer UNTs unregistered.
+    if CONFIG['ALERT_ONCE'] and CONFIG['MINIMUM_AGE'] == 0:
+        record_scan(codename, scan_started)
+
     if issues_found:
         sys.exit(1)